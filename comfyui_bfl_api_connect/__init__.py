@@ -1,25 +1,43 @@
 import argparse
+import atexit
+import sys
+import threading
 
+from collections.abc import Callable
 from enum import Enum
-from pydantic import BaseModel, Field, NonNegativeInt
-import webbrowser
-import httpx
-import time
-import random
+from typing import TYPE_CHECKING
+from pydantic import BaseModel, ConfigDict, Field, NonNegativeInt
+
+if TYPE_CHECKING:
+    import asyncio
+
+    import httpx
+
+# httpx, webbrowser, asyncio etc. are imported lazily inside the functions
+# that need them, so importing this module just for the Pydantic models
+# (e.g. from a ComfyUI node) stays cheap.
 
 
 class ImageVariant(str, Enum):
+    __slots__ = ()
+
     dev = "flux-dev"
     pro = "flux-pro"
     proplus = "flux-pro-1.1"
 
 
 class AsyncResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     id: str
 
 
 class HTTPValidationError(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     class HTTPValidationErrorDetail(BaseModel):
+        model_config = ConfigDict(frozen=True, extra="ignore")
+
         loc: list[str | int]
         msg: str
         type: str
@@ -28,6 +46,8 @@ class HTTPValidationError(BaseModel):
 
 
 class StatusResponse(str, Enum):
+    __slots__ = ()
+
     TaskNotFound = "Task not found"
     Pending = "Pending"
     RequestModerated = "Request Moderated"
@@ -37,12 +57,16 @@ class StatusResponse(str, Enum):
 
 
 class ResultResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     id: str
     status: StatusResponse
     result: dict | None
 
 
 class ImageRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     prompt: str = "ein fantastisches bild"
     width: int = Field(1024, ge=256, le=1440, multiple_of=32)
     height: int = Field(1024, ge=256, le=1440, multiple_of=32)
@@ -55,73 +79,363 @@ class ImageRequest(BaseModel):
 
 
 class ValidationError(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     loc: list[str]
     msg: str
     type: str
 
 
-def pretty_dict_str(d: dict) -> str:
+# Sample URLs of completed jobs. Re-running the same (request, variant) pair
+# reuses the cached URL instead of submitting a new job and polling it to
+# completion. Failed or moderated jobs are not cached. ImageRequest is frozen
+# and therefore hashable, so the pair itself is the key.
+_SAMPLE_CACHE: dict[tuple[ImageRequest, ImageVariant], str] = {}
+
+
+# Cached HTTP clients, one per (API key, event loop), so repeated run_flux
+# calls on the same loop (e.g. from a ComfyUI node across workflow
+# executions) reuse the pooled TCP/TLS connections instead of rebuilding
+# them on every invocation. The loop is part of the key because a client's
+# pooled connections are bound to the loop they were opened on: reusing
+# them after that loop is closed (each asyncio.run closes its loop) fails
+# with "Event loop is closed".
+_CLIENTS: dict[tuple[str, "asyncio.AbstractEventLoop"], "httpx.AsyncClient"] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _get_client(api_key: str) -> "httpx.AsyncClient":
+    import asyncio
+    import hashlib
+
+    import httpx
+
+    key_id = (hashlib.sha256(api_key.encode()).hexdigest(), asyncio.get_running_loop())
+    with _CLIENTS_LOCK:
+        # Evict clients from dead loops; their connections are unusable.
+        for cached_key in [k for k in _CLIENTS if k[1].is_closed()]:
+            del _CLIENTS[cached_key]
+        client = _CLIENTS.get(key_id)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url="https://api.bfl.ml/v1",
+                http2=True,
+                headers={"x-key": api_key},
+                limits=httpx.Limits(
+                    max_keepalive_connections=4, keepalive_expiry=60.0
+                ),
+                timeout=httpx.Timeout(30.0),
+            )
+            _CLIENTS[key_id] = client
+    return client
+
+
+def _close_clients() -> None:
+    import asyncio
+
+    with _CLIENTS_LOCK:
+        for (_, loop), client in _CLIENTS.items():
+            if loop.is_closed():
+                continue
+            try:
+                asyncio.run(client.aclose())
+            except Exception:
+                # Best effort during interpreter shutdown; connections can
+                # raise assorted transport errors when torn down off-loop.
+                pass
+        _CLIENTS.clear()
+
+
+atexit.register(_close_clients)
+
+
+# Per-status handlers, dispatched via an O(1) dict lookup instead of a
+# match/case chain in the polling loop. Each returns True when polling is done.
+def _on_ready(result_response: ResultResponse) -> bool:
+    print(f"Result ready:\n{result_response.result}")
+    return True
+
+
+def _on_error(result_response: ResultResponse) -> bool:
+    print(f"Error: {result_response.result}")
+    return True
+
+
+def _on_pending(result_response: ResultResponse) -> bool:
+    print("Job still pending ...")
+    return False
+
+
+def _on_request_moderated(result_response: ResultResponse) -> bool:
+    print("Request moderated ...")
+    return True
+
+
+def _on_content_moderated(result_response: ResultResponse) -> bool:
+    print("Content moderated ...")
+    return True
+
+
+def _on_task_not_found(result_response: ResultResponse) -> bool:
+    print("Task not found ...")
+    return True
+
+
+def _on_unknown(result_response: ResultResponse) -> bool:
+    raise ValueError(f"Unknown status: {result_response.status}")
+
+
+_HANDLERS: dict[StatusResponse, Callable[[ResultResponse], bool]] = {
+    StatusResponse.Ready: _on_ready,
+    StatusResponse.Error: _on_error,
+    StatusResponse.Pending: _on_pending,
+    StatusResponse.RequestModerated: _on_request_moderated,
+    StatusResponse.ContentModerated: _on_content_moderated,
+    StatusResponse.TaskNotFound: _on_task_not_found,
+}
+
+
+def _parse_result(content: bytes | str) -> ResultResponse | None:
+    """Parse one get_result payload, or None while the job is still pending.
+
+    Pending payloads carry no result worth inspecting, so a cheap status peek
+    on the raw JSON skips the model validation that the vast majority of
+    polls would otherwise pay.
+    """
     import json
 
-    return json.dumps(d, sort_keys=True, indent=4)
+    raw = json.loads(content)
+    if raw.get("status") == StatusResponse.Pending:
+        return None
+    return ResultResponse.model_validate(raw)
+
 
+async def _hedged_get(
+    client: "httpx.AsyncClient",
+    url: str,
+    params: dict,
+    hedge_delay: float = 2.0,
+) -> "httpx.Response":
+    """GET with a hedged duplicate to cut tail latency.
 
-def run_flux(
+    If the first request has not completed within hedge_delay seconds, fire an
+    identical second one and return whichever finishes first. Only safe for
+    idempotent requests such as /get_result.
+    """
+    import asyncio
+
+    first = asyncio.ensure_future(client.get(url, params=params))
+    try:
+        return await asyncio.wait_for(asyncio.shield(first), timeout=hedge_delay)
+    except asyncio.TimeoutError:
+        pass
+    second = asyncio.ensure_future(client.get(url, params=params))
+    done, pending = await asyncio.wait(
+        {first, second}, return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    # Both may have completed in the same wakeup; prefer one that succeeded
+    # so a transient failure on one leg does not mask the other's response.
+    # Checking exception() on every task also marks losing failures as
+    # retrieved, silencing "exception was never retrieved" warnings.
+    succeeded = [task for task in done if task.exception() is None]
+    if succeeded:
+        return succeeded[0].result()
+    # Every completed leg failed; surface one of the errors.
+    return next(iter(done)).result()
+
+
+async def run_flux(
     api_key: str,
     image_request_body: ImageRequest,
     variant: ImageVariant = ImageVariant.proplus,
-) -> None:
+    max_wait_seconds: float = 300.0,
+) -> str | None:
+    import asyncio
+    import json
+    import random
+    import time
+
+    key = (image_request_body, variant)
+    if key in _SAMPLE_CACHE:
+        print(f"Result cached:\n{_SAMPLE_CACHE[key]}")
+        return _SAMPLE_CACHE[key]
+
     bfl_url = f"https://api.bfl.ml/v1/{str(variant.value)}"
-    print(
-        f"Posting job to {bfl_url}:\n{pretty_dict_str(image_request_body.model_dump())}\n"
-    )
-    res = httpx.post(
-        bfl_url,
-        headers={"x-key": api_key},
-        json=image_request_body.model_dump(),
+    # Serialize the request once via Pydantic's Rust serializer; the same JSON
+    # is posted verbatim so httpx does not re-serialize a dict.
+    payload_json = image_request_body.model_dump_json()
+    print(f"Posting job to {bfl_url}:\n{image_request_body.model_dump_json(indent=4)}\n")
+    # Shared pooled client for this API key: the POST and all polling GETs of
+    # every job on this event loop reuse the same HTTP/2 connections.
+    client = _get_client(api_key)
+    res = await client.post(
+        f"/{variant.value}",
+        content=payload_json,
+        headers={"content-type": "application/json"},
     )
     res.raise_for_status()
-    async_response = AsyncResponse(**res.json())
+    async_response = AsyncResponse.model_validate_json(res.content)
     job_id = async_response.id
 
-    n = 1  # exponential backoff counter. For now not used.
+    sample_url: str | None = None
+
+    def handle_result(result_response: ResultResponse) -> bool:
+        """Process one status update. Returns True when polling is done."""
+        nonlocal sample_url
+        done = _HANDLERS.get(result_response.status, _on_unknown)(result_response)
+        if done and result_response.status is StatusResponse.Ready:
+            # Job-local follow-up that the module-level handler cannot do:
+            # extract and cache the sample URL for this request.
+            if result_response.result is None:
+                raise RuntimeError(f"Job {job_id} is Ready but has no result")
+            if (sample_url := result_response.result.get("sample")) is None:
+                raise RuntimeError(f"Job {job_id} result has no sample URL")
+            _SAMPLE_CACHE[key] = sample_url
+        return done
+
+    n = 1  # exponential backoff counter
+    polls = 0
+    last_status: StatusResponse | None = None
+    long_poll = True
+    # Total polling budget, so a stuck job cannot keep us waiting forever.
+    deadline = time.monotonic() + max_wait_seconds
     while True:
-        # wait with exponential backoff
-        time.sleep(0.5 * (2**n) + (random.randint(0, 1000) / 1000))
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"Job {job_id} did not finish within {max_wait_seconds} s"
+            )
+        if long_poll:
+            # Hold a single chunked GET open and let the server push status
+            # updates, instead of paying one round-trip per check. Falls
+            # back to plain polling if the server rejects the wait param.
+            stream_started = time.monotonic()
+            async with client.stream(
+                "GET", "/get_result", params={"id": job_id, "wait": 30}
+            ) as res:
+                if res.status_code in (400, 404):
+                    long_poll = False
+                    continue
+                res.raise_for_status()
+                async for line in res.aiter_lines():
+                    if not line:
+                        continue
+                    try:
+                        result_response = _parse_result(line)
+                    except json.JSONDecodeError:
+                        # Not a newline-delimited JSON event stream; the
+                        # server does not speak long-poll. Fall back.
+                        long_poll = False
+                        break
+                    if result_response is None:
+                        print("Job still pending ...")
+                        last_status = StatusResponse.Pending
+                        continue
+                    if result_response.status != last_status:
+                        last_status = result_response.status
+                    if handle_result(result_response):
+                        return sample_url
+            if long_poll and time.monotonic() - stream_started < 5.0:
+                # The server answered well within the wait window without a
+                # terminal status, so it most likely ignored the wait param
+                # (plain polling behind a 200). Reconnecting immediately
+                # would hammer the API in a tight loop; fall back instead.
+                long_poll = False
+            # Reconnect, or fall back to backoff polling if long-poll was
+            # just disabled.
+            continue
+        # The first two polls are nearly immediate to catch fast completions;
+        # after that, back off exponentially with jitter, capped at 16 s.
+        if polls < 2:
+            delay = 0.25
+        else:
+            delay = min(16.0, 0.5 * (1 << n)) + random.random()
+            n = min(n + 1, 5)
+        polls += 1
+        await asyncio.sleep(delay)
         # fetch result
         print(f"Fetching status of job {job_id} ...")
-        res = httpx.get(
-            "https://api.bfl.ml/v1/get_result",
-            headers={"x-key": api_key},
-            params={"id": job_id},
-        )
+        res = await _hedged_get(client, "/get_result", {"id": job_id})
         res.raise_for_status()
-        result_response = ResultResponse(**res.json())
-        match result_response.status:
-            case StatusResponse.Ready:
-                print(f"Result ready:\n{result_response.result}")
-                assert result_response.result is not None
-                sample_url = result_response.result.get("sample")
-                assert sample_url is not None
-                webbrowser.open(sample_url, new=0, autoraise=True)
-                return
-            case StatusResponse.Error:
-                print(f"Error: {result_response.result}")
-                return
-            case StatusResponse.Pending:
-                print("Job still pending ...")
-                pass
-            case StatusResponse.RequestModerated:
-                print("Request moderated ...")
-                return
-            case StatusResponse.ContentModerated:
-                print("Content moderated ...")
-                return
-            case StatusResponse.TaskNotFound:
-                print("Task not found ...")
-                return
-            case _:
-                raise ValueError(f"Unknown status: {result_response.status}")
+        result_response = _parse_result(res.content)
+        if result_response is None:
+            print("Job still pending ...")
+            if last_status != StatusResponse.Pending:
+                # Status changed; start backing off from scratch again.
+                n = 1
+                last_status = StatusResponse.Pending
+            continue
+        if result_response.status != last_status:
+            # Status changed; start backing off from scratch again.
+            n = 1
+            last_status = result_response.status
+        if handle_result(result_response):
+            return sample_url
+
+
+async def run_flux_batch(
+    api_key: str,
+    image_requests: list[tuple[ImageRequest, ImageVariant]],
+    max_concurrency: int = 8,
+) -> list[str | None]:
+    """Dispatch and poll many jobs concurrently.
+
+    All jobs share the per-loop client pool, so their requests multiplex
+    over the same HTTP/2 connections. Total wall time is roughly that of the
+    slowest job instead of the sum of all jobs. Returns the sample URLs in
+    input order (None for jobs that did not produce one).
+    """
+    import asyncio
+
+    # Bound concurrency so a large batch does not open too many sockets at once.
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(
+        image_request_body: ImageRequest, variant: ImageVariant
+    ) -> str | None:
+        async with semaphore:
+            return await run_flux(api_key, image_request_body, variant=variant)
+
+    return await asyncio.gather(*(run_one(r, v) for r, v in image_requests))
+
+
+# argparse type= callables that enforce the ImageRequest field bounds up
+# front, so main can build the model with model_construct and skip a second
+# validation pass through pydantic-core.
+def _dimension(s: str) -> int:
+    value = int(s)
+    if not (256 <= value <= 1440 and value % 32 == 0):
+        raise argparse.ArgumentTypeError("must be in 256-1440 and a multiple of 32")
+    return value
+
+
+def _seed(s: str) -> int:
+    value = int(s)
+    if value < 0:
+        raise argparse.ArgumentTypeError("must be non-negative")
+    return value
+
+
+def _guidance(s: str) -> float:
+    value = float(s)
+    if not 1.5 <= value <= 5.0:
+        raise argparse.ArgumentTypeError("must be in 1.5-5.0")
+    return value
+
+
+def _safety_tolerance(s: str) -> int:
+    value = int(s)
+    if not 0 <= value <= 6:
+        raise argparse.ArgumentTypeError("must be in 0-6")
+    return value
+
+
+def _interval(s: str) -> int:
+    value = int(s)
+    if not 1 <= value <= 4:
+        raise argparse.ArgumentTypeError("must be in 1-4")
+    return value
 
 
 def main() -> None:
@@ -132,13 +446,13 @@ def main() -> None:
     parser.add_argument("--prompt", type=str, default="ein fantastisches bild")
     parser.add_argument(
         "--width",
-        type=int,
+        type=_dimension,
         default=1024,
         help="Width of the image (256-1440, multiple of 32)",
     )
     parser.add_argument(
         "--height",
-        type=int,
+        type=_dimension,
         default=1024,
         help="Height of the image (256-1440, multiple of 32)",
     )
@@ -156,22 +470,49 @@ def main() -> None:
         "--prompt_upsampling", action="store_true", help="Enable prompt upsampling"
     )
     parser.add_argument(
-        "--seed", type=int, default=None, help="Seed for random number generation"
+        "--seed", type=_seed, default=None, help="Seed for random number generation"
     )
     parser.add_argument(
-        "--guidance", type=float, default=None, help="Guidance value (1.5-5.0)"
+        "--guidance", type=_guidance, default=None, help="Guidance value (1.5-5.0)"
     )
     parser.add_argument(
-        "--safety_tolerance", type=int, default=2, help="Safety tolerance level (0-6)"
+        "--safety_tolerance",
+        type=_safety_tolerance,
+        default=2,
+        help="Safety tolerance level (0-6)",
     )
     parser.add_argument(
-        "--interval", type=int, default=None, help="Interval value (1-4)"
+        "--interval", type=_interval, default=None, help="Interval value (1-4)"
+    )
+    parser.add_argument(
+        "--open-browser",
+        action=argparse.BooleanOptionalAction,
+        default=sys.stdout.isatty(),
+        help="Open the resulting sample URL in a browser (default: only on a TTY)",
     )
 
     args = parser.parse_args()
-    image_request_input = ImageRequest(**vars(args))
+    # argparse already enforced the bounds, so skip Pydantic validation.
+    fields = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ("api_key", "variant", "open_browser")
+    }
+    image_request_input = ImageRequest.model_construct(**fields)
+
+    import asyncio
+
+    sample_url = asyncio.run(
+        run_flux(args.api_key, image_request_input, variant=args.variant)
+    )
+    if sample_url is not None:
+        if args.open_browser:
+            import webbrowser
 
-    run_flux(args.api_key, image_request_input, variant=args.variant)
+            webbrowser.open(sample_url, new=0, autoraise=True)
+        else:
+            # Headless/batch invocation: just emit the URL for the caller.
+            print(sample_url)
 
 
 if __name__ == "__main__":